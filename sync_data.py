@@ -1,125 +1,500 @@
 import os
 import sys
+import json
+import time
+import random
+import atexit
 import logging
+import logging.handlers
 import argparse
-from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import functools
+import itertools
+import queue
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import akshare as ak
-import pandas as pd
+import httpx
+import orjson
+from psycopg_pool import ConnectionPool
 from supabase import create_client, Client
 
 # --- 配置区域 ---
 
+# 日志记录先放入内存队列，由后台监听线程统一写到标准输出，避免多个工作线程争抢 stdout
+log_queue = queue.Queue()
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+log_listener.start()
+atexit.register(log_listener.stop)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
-    stream=sys.stdout
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
+# httpx 默认以 INFO 级别记录每一次请求，会淹没按 PROGRESS_LOG_INTERVAL 汇总的进度日志
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # 从环境变量中读取 Supabase 配置
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
+# 可选：Supabase 的 Postgres 直连字符串，'full' / 'partial' 历史同步时用于 COPY 批量导入
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+# 中证800指数代码
+CSI800_SYMBOL = "000906"
+# 每日更新及校验修复时回溯的天数
+DAILY_LOOKBACK_DAYS = 5
+# 所有日期均按北京时间计算 (GitHub Actions 运行器为 UTC)
+BEIJING_TZ = timezone(timedelta(hours=8))
+# 当日K线视为最终数据的时间 (北京时间 HH:MM)：A股 15:00 收盘，留 30 分钟余量等待东方财富发布收盘后的日K线；
+# 此前运行写入的当日K线可能尚未收盘，之后仍需重新写入
+MARKET_SETTLED_TIME = "15:30"
+
+# 连续多少个交易日的每日同步都没有新数据的股票视为长期停牌或退市，在 daily 中跳过
+# ('full' / 'partial' 同步时重置)；被跳过的股票每隔若干天重新检查一次，以便发现复牌
+EMPTY_STREAK_LIMIT = 30
+EMPTY_STREAK_REPROBE_DAYS = 7
 
 # 设置并发下载的线程数
 MAX_WORKERS = 10
-# 设置数据库分批插入的大小
-BATCH_SIZE = 50
+# 设置数据库分批插入的大小 (按记录行数计，约 90 字节/行，单次请求约 500KB)
+BATCH_ROW_SIZE = 5000
+# 单次 PostgREST upsert 请求的行数上限 (一只股票的全量历史可能使批次超出 BATCH_ROW_SIZE)
+MAX_UPSERT_ROWS = 10000
+# 同时提交到线程池的最大任务数 (滚动提交，限制待处理队列的内存占用)
+SUBMIT_WINDOW = 2 * MAX_WORKERS
+# 每处理多少只股票输出一次进度汇总
+PROGRESS_LOG_INTERVAL = 50
+# 待写入批次队列的最大长度，下载速度超过写入速度时用于限制内存占用
+UPSERT_QUEUE_SIZE = 4
+
+# 本地 JSON 缓存目录，在 GitHub Actions 中通过 actions/cache 跨运行保留
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+# 成分股列表缓存有效期 (秒)：中证800 每半年调整一次成分，7 天内的列表足够新
+STOCK_INFO_CACHE_TTL = 7 * 24 * 60 * 60
+
+# 东方财富日K线接口 (即 ak.stock_zh_a_hist 底层调用的接口)
+EASTMONEY_KLINE_URL = "https://push2his.eastmoney.com/api/qt/stock/kline/get"
+# 只向接口请求入库所需的 K 线字段 (f51-f56)：日期, 开盘, 收盘, 最高, 最低, 成交量
+KLINE_FIELDS = "f51,f52,f53,f54,f55,f56"
+# 写入数据库的列 (顺序即记录字段顺序)
+REQUIRED_COLUMNS = (
+    'trade_date', 'stock_code', 'stock_name',
+    'open', 'high', 'low', 'close', 'volume'
+)
+
+# COPY 批量导入：先写入会话临时表，再合并到正式表，以保持 upsert 语义
+COPY_STAGING_SQL = (
+    "CREATE TEMP TABLE csi800_daily_staging "
+    "(LIKE csi800_daily_data INCLUDING DEFAULTS) ON COMMIT DROP"
+)
+COPY_SQL = f"COPY csi800_daily_staging ({', '.join(REQUIRED_COLUMNS)}) FROM STDIN"
+COPY_MERGE_SQL = (
+    f"INSERT INTO csi800_daily_data ({', '.join(REQUIRED_COLUMNS)}) "
+    f"SELECT {', '.join(REQUIRED_COLUMNS)} FROM csi800_daily_staging "
+    "ON CONFLICT (trade_date, stock_code) DO UPDATE SET "
+    + ", ".join(f"{col} = EXCLUDED.{col}" for col in REQUIRED_COLUMNS[2:])
+)
+
+# COPY 导入使用的小型 Postgres 连接池 (Supabase 对客户端连接数有硬性上限)，仅在需要时打开
+# prepare_threshold=None 以兼容 Supabase 连接池 (pgbouncer) 不支持服务端预备语句的情况
+copy_pool = ConnectionPool(
+    DATABASE_URL or "",
+    min_size=2,
+    max_size=5,
+    max_idle=1800,
+    kwargs={'sslmode': 'require', 'prepare_threshold': None},
+    check=ConnectionPool.check_connection,
+    open=False
+)
+
+# 东方财富接口的请求速率上限 (次/秒)，以及遇到限流或瞬时错误时的重试次数与退避基数 (秒)
+EASTMONEY_RATE_LIMIT = 20
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 1.0
+
+# 所有下载线程共享的 HTTP 客户端：复用 keep-alive 连接，避免每只股票都重新进行 TCP/TLS 握手
+http_client = httpx.Client(
+    timeout=15,
+    limits=httpx.Limits(max_connections=MAX_WORKERS, max_keepalive_connections=MAX_WORKERS)
+)
+
+
+class RateLimiter:
+    """线程安全的令牌桶限速器：每秒补充 rate 个令牌，最多积累 rate 个"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """取得一个令牌，令牌不足时阻塞等待"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+eastmoney_limiter = RateLimiter(EASTMONEY_RATE_LIMIT)
 
 # --- 数据获取与处理函数 ---
 
+def load_cache(name: str, ttl: int = None):
+    """辅助函数：读取未过期的本地 JSON 缓存 (ttl 为 None 时永不过期)，缓存不存在或已过期时返回 None"""
+    cache_path = os.path.join(CACHE_DIR, f"{name}.json")
+    try:
+        if ttl is not None and time.time() - os.path.getmtime(cache_path) > ttl:
+            return None
+        with open(cache_path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_cache(name: str, data):
+    """辅助函数：原子地写入本地 JSON 缓存 (先写临时文件再 os.replace)"""
+    cache_path = os.path.join(CACHE_DIR, f"{name}.json")
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.warning(f"写入本地缓存 {name} 失败 - {e}")
+
+
+@functools.lru_cache(maxsize=1)
 def get_csi800_stock_info() -> dict:
     """
-    获取最新的中证800成分股代码和对应的公司名称
+    获取最新的中证800成分股代码和对应的公司名称。
+    结果在进程内记忆化，并缓存到本地文件 (有效期 7 天)。
     """
+    stock_info = load_cache("csi800_members", STOCK_INFO_CACHE_TTL)
+    if stock_info:
+        logging.info(f"使用本地缓存的中证800成分股列表，共 {len(stock_info)} 只股票。")
+        return stock_info
+
     try:
-        stock_df = ak.index_stock_cons_csindex(symbol="000906")
+        stock_df = ak.index_stock_cons_csindex(symbol=CSI800_SYMBOL)
         logging.info(f"成功从中证指数官网获取中证800成分股，共 {len(stock_df)} 只股票。")
-        return pd.Series(stock_df['成分券名称'].values, index=stock_df['成分券代码']).to_dict()
+        stock_info = dict(zip(stock_df['成分券代码'].tolist(), stock_df['成分券名称'].tolist()))
     except Exception as e:
         logging.error(f"错误：获取中证800成分股列表失败 - {e}")
         return {}
 
+    save_cache("csi800_members", stock_info)
+    return stock_info
+
+
+def get_eastmoney_secid(stock_code: str) -> str:
+    """辅助函数：将股票代码转换为东方财富的 secid (沪市为 1.，深市为 0.)"""
+    return f"1.{stock_code}" if stock_code.startswith('6') else f"0.{stock_code}"
 
-def get_stock_history(stock_code: str, stock_name: str, start_date: str) -> pd.DataFrame:
+
+def get_with_retry(url: str, params: dict) -> httpx.Response:
+    """
+    辅助函数：经限速器发送 GET 请求。遇到 429/5xx 或连接错误时按指数退避加随机抖动重试，
+    429 响应带有 Retry-After 时以其为准。重试耗尽后抛出最后一次的异常。
     """
-    获取单只股票历史数据。不包含内部重试逻辑。
+    for attempt in range(MAX_RETRIES + 1):
+        eastmoney_limiter.acquire()
+        delay = RETRY_BASE_DELAY * 2 ** attempt + random.uniform(0, 0.5)
+        try:
+            response = http_client.get(url, params=params)
+        except httpx.TransportError:
+            if attempt == MAX_RETRIES:
+                raise
+        else:
+            retryable = response.status_code == 429 or response.status_code >= 500
+            if not retryable or attempt == MAX_RETRIES:
+                response.raise_for_status()
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = float(retry_after)
+        time.sleep(delay)
+
+
+def fetch_klines(stock_code: str, start_date: str) -> list:
     """
+    直接请求东方财富日K线接口 (前复权)，返回原始的 K 线字符串列表 (逗号分隔，字段顺序同 KLINE_FIELDS)。
+    """
+    params = {
+        "fields1": "f1,f2,f3,f4,f5,f6",
+        "fields2": KLINE_FIELDS,
+        "ut": "7eea3edcaed734bea9cbfc24409ed989",
+        "klt": "101",
+        "fqt": "1",
+        "secid": get_eastmoney_secid(stock_code),
+        "beg": start_date,
+        "end": "20500101",
+    }
+    response = get_with_retry(EASTMONEY_KLINE_URL, params)
+
+    data = orjson.loads(response.content).get("data")
+    if not data:
+        return []
+    return data.get("klines") or []
+
+
+def parse_number(value: str):
+    """辅助函数：解析接口返回的数值字符串，无法解析时返回 None (同 pd.to_numeric 的 errors='coerce')"""
     try:
-        stock_hist_df = ak.stock_zh_a_hist(symbol=stock_code, period="daily", start_date=start_date, adjust="qfq")
-
-        if not stock_hist_df.empty:
-            stock_hist_df.rename(columns={
-                '日期': 'trade_date', '开盘': 'open', '收盘': 'close', '最高': 'high',
-                '最低': 'low', '成交量': 'volume'
-            }, inplace=True)
-            stock_hist_df['stock_code'] = stock_code
-            stock_hist_df['stock_name'] = stock_name
-            stock_hist_df['trade_date'] = pd.to_datetime(stock_hist_df['trade_date']).dt.strftime('%Y-%m-%d')
-            
-            required_columns = [
-                'trade_date', 'stock_code', 'stock_name',
-                'open', 'high', 'low', 'close', 'volume'
-            ]
-            return stock_hist_df[required_columns]
+        return int(value) if value.isdigit() else float(value)
+    except ValueError:
+        return None
+
+
+def get_stock_history(stock_code: str, stock_name: str, start_date: str, latest_date: str = None) -> list:
+    """
+    获取单只股票历史数据，直接返回可用于 upsert 的记录列表。
+    仅对限流和瞬时网络错误做有限次重试，其余失败交由校验任务修复。
+    若提供 latest_date (数据库中该股票的最新交易日)，则只返回该日及此后的数据：
+    该日重新获取并覆盖写入，以修正盘中写入的未收盘K线。
+    """
+    try:
+        records = []
+        # 直接由 K 线字符串构建记录，不经过 DataFrame；接口返回的日期本身就是 'YYYY-MM-DD' 字符串
+        for line in fetch_klines(stock_code, start_date):
+            trade_date, open_price, close_price, high_price, low_price, volume = line.split(",")
+            # 跳过数据库中最新日期之前的数据，避免重复上传相同的数据
+            if latest_date and trade_date < latest_date:
+                continue
+            # 字段顺序与 REQUIRED_COLUMNS 一致 (COPY 写入依赖此顺序)
+            records.append({
+                'trade_date': trade_date,
+                'stock_code': stock_code,
+                'stock_name': stock_name,
+                'open': parse_number(open_price),
+                'high': parse_number(high_price),
+                'low': parse_number(low_price),
+                'close': parse_number(close_price),
+                'volume': parse_number(volume)
+            })
+        return records
             
     except Exception as e:
         logging.warning(f"获取股票 {stock_code} ({stock_name}) 数据失败 - {e}")
         raise  # 重新抛出异常，以便上层知道失败了
 
-    return pd.DataFrame()
+
+def configure_postgrest_session(supabase_client: Client):
+    """
+    为 PostgREST 换上一个长 keep-alive 的 HTTP/2 客户端。
+    httpx 默认 5 秒即回收空闲连接，而两次批量 upsert 之间的下载耗时远超于此，会导致每批都重新握手。
+    """
+    postgrest = supabase_client.postgrest
+    old_session = postgrest.session
+    postgrest.session = httpx.Client(
+        base_url=old_session.base_url,
+        headers=old_session.headers,
+        timeout=old_session.timeout,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=300)
+    )
+    old_session.close()
+
+
+def get_db_latest_dates(supabase_client: Client, stock_codes) -> dict:
+    """
+    辅助函数：通过数据库端聚合 (RPC) 获取指定股票的最新交易日，返回 {stock_code: 'YYYY-MM-DD'}。
+    只查询当前成分股：表中历年调出的股票会使全表汇总超过 PostgREST 默认的 1000 行上限而被截断。
+    """
+    response = supabase_client.rpc("get_stock_latest_dates", {"codes": list(stock_codes)}).execute()
+    return {row['stock_code']: row['latest_date'] for row in response.data}
 
 
-def execute_batch_upsert(supabase_client: Client, data_frames: list) -> int:
+def execute_batch_upsert(supabase_client: Client, records: list) -> int:
     """辅助函数：执行批量插入并返回插入的记录数"""
-    if not data_frames:
+    if not records:
         return 0
         
-    full_df = pd.concat(data_frames, ignore_index=True)
-    data_to_insert = full_df.to_dict(orient='records')
-    record_count = len(data_to_insert)
+    record_count = len(records)
+    
+    inserted_count = 0
     
     logging.info(f"准备批量插入 {record_count} 条数据 (批次)...")
     try:
-        supabase_client.table("csi800_daily_data").upsert(data_to_insert).execute()
+        # 单次请求最多 MAX_UPSERT_ROWS 行，超出的批次拆分为多次请求
+        for offset in range(0, record_count, MAX_UPSERT_ROWS):
+            chunk = records[offset:offset + MAX_UPSERT_ROWS]
+            # 直接用 orjson 序列化请求体并 POST 到 PostgREST，绕过 supabase-py 内部的标准库 json 序列化
+            response = supabase_client.postgrest.session.post(
+                "/csi800_daily_data",
+                content=orjson.dumps(chunk),
+                headers={"Content-Type": "application/json", "Prefer": "resolution=merge-duplicates,return=minimal"}
+            )
+            response.raise_for_status()
+            inserted_count += len(chunk)
         logging.info(f"✅ 成功同步批次，共 {record_count} 条记录。")
+    except Exception as e:
+        logging.error(f"数据库错误：批次插入数据失败 (已写入 {inserted_count}/{record_count} 条) - {e}")
+    return inserted_count
+
+
+def execute_copy_upsert(records: list) -> int:
+    """辅助函数：通过 Postgres COPY 协议批量写入并返回写入的记录数"""
+    if not records:
+        return 0
+
+    record_count = len(records)
+
+    logging.info(f"准备通过 COPY 批量写入 {record_count} 条数据 (批次)...")
+    try:
+        with copy_pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(COPY_STAGING_SQL)
+                with cur.copy(COPY_SQL) as copy:
+                    for record in records:
+                        copy.write_row(tuple(record.values()))
+                cur.execute(COPY_MERGE_SQL)
+        logging.info(f"✅ 成功通过 COPY 同步批次，共 {record_count} 条记录。")
         return record_count
     except Exception as e:
-        logging.error(f"数据库错误：批次插入数据失败 - {e}")
+        logging.error(f"数据库错误：COPY 批次写入失败 - {e}")
         return 0
 
 
-def fetch_and_insert_stocks(supabase_client: Client, stock_info: dict, start_date: str, task_desc: str):
+def upsert_worker(supabase_client: Client, batch_queue: queue.Queue, upsert_stats: dict, use_copy: bool):
+    """后台写入线程：从队列中取出批次并写入数据库，收到 None 时退出"""
+    while True:
+        records = batch_queue.get()
+        if records is None:
+            break
+        if use_copy:
+            upsert_stats['inserted'] += execute_copy_upsert(records)
+        else:
+            upsert_stats['inserted'] += execute_batch_upsert(supabase_client, records)
+
+
+def fetch_and_insert_stocks(supabase_client: Client, stock_info: dict, start_date: str, task_desc: str,
+                            start_dates: dict = None, use_copy: bool = False, latest_dates: dict = None) -> dict:
     """
     【通用模式】使用并发技术获取股票数据，并分批插入数据库。
+    数据库写入由独立的后台线程完成，下载与写入互不阻塞。
+    start_dates 可为个别股票指定起始日期，未指定的股票使用 start_date。
+    use_copy 为 True 时通过 Postgres COPY 直连写入，而非 PostgREST。
+    latest_dates 为各股票在数据库中的最新交易日，提供时只写入该日 (覆盖更新) 及此后的新数据。
+    返回成功获取的各股票的新数据条数 {stock_code: count} (不含重新写入的最新日)，获取失败的股票不包含在内。
     """
     logging.info(f"开始执行 '{task_desc}' 任务，目标股票数: {len(stock_info)}，起始日期: {start_date}")
     
-    batch_data_frames = []
-    total_inserted_records = 0
+    batch_records = []
+    fetched_counts = {}
+    fetched_record_count = 0
     total_stocks = len(stock_info)
+    debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
+    start_dates = start_dates or {}
+    latest_dates = latest_dates or {}
+    # 起始日期越早、数据量越大，先提交耗时最长的任务，避免个别长任务在末尾拖慢整体完成时间
+    work_items = sorted(stock_info.items(), key=lambda item: start_dates.get(item[0], start_date))
+
+    batch_queue = queue.Queue(maxsize=UPSERT_QUEUE_SIZE)
+    upsert_stats = {'inserted': 0}
+    upsert_thread = threading.Thread(
+        target=upsert_worker,
+        args=(supabase_client, batch_queue, upsert_stats, use_copy)
+    )
+    upsert_thread.start()
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(get_stock_history, code, name, start_date): (code, name) 
-                   for code, name in stock_info.items()}
-
-        for i, future in enumerate(as_completed(futures)):
-            code, name = futures[future]
-            try:
-                df = future.result()
-                if not df.empty:
-                    batch_data_frames.append(df)
-                    logging.info(f"进度: {i + 1}/{total_stocks} | 成功获取 {code} ({name}) 的 {len(df)} 条数据。")
-            except Exception as e:
-                logging.error(f"进度: {i + 1}/{total_stocks} | 处理股票 {code} ({name}) 时发生严重错误: {e}")
-
-            # 分批处理逻辑
-            if len(batch_data_frames) >= BATCH_SIZE or (i + 1) == total_stocks:
-                inserted_count = execute_batch_upsert(supabase_client, batch_data_frames)
-                total_inserted_records += inserted_count
-                batch_data_frames = [] # 清空批次
-
-    logging.info(f"🎉 '{task_desc}' 任务完成！总共成功插入 {total_inserted_records} 条记录。")
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # 滚动提交：任何时刻最多只有 SUBMIT_WINDOW 个未完成任务，完成一个再补交一个
+            work_iter = iter(work_items)
+            pending = {}
+            processed = 0
+
+            while True:
+                for code, name in itertools.islice(work_iter, SUBMIT_WINDOW - len(pending)):
+                    future = executor.submit(get_stock_history, code, name, start_dates.get(code, start_date),
+                                             latest_dates.get(code))
+                    pending[future] = (code, name)
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    code, name = pending.pop(future)
+                    processed += 1
+                    try:
+                        records = future.result()
+                        # 重新写入的数据库最新一日不计为新数据
+                        latest_date = latest_dates.get(code)
+                        fetched_counts[code] = sum(1 for record in records if record['trade_date'] != latest_date)
+                        if records:
+                            batch_records.extend(records)
+                            fetched_record_count += len(records)
+                            if debug_enabled:
+                                logging.debug(f"进度: {processed}/{total_stocks} | 成功获取 {code} ({name}) 的 {len(records)} 条数据。")
+                    except Exception as e:
+                        logging.error(f"进度: {processed}/{total_stocks} | 处理股票 {code} ({name}) 时发生严重错误: {e}")
+
+                    if processed % PROGRESS_LOG_INTERVAL == 0 or processed == total_stocks:
+                        logging.info(f"进度: {processed}/{total_stocks} | 累计获取 {fetched_record_count} 条数据。")
+
+                    # 分批处理逻辑：将批次交给后台线程写入
+                    if len(batch_records) >= BATCH_ROW_SIZE or processed == total_stocks:
+                        if batch_records:
+                            batch_queue.put(batch_records)
+                        batch_records = [] # 清空批次
+    finally:
+        batch_queue.put(None)
+        upsert_thread.join()
+
+    logging.info(f"🎉 '{task_desc}' 任务完成！总共成功插入 {upsert_stats['inserted']} 条记录。")
+    return fetched_counts
+
+
+def filter_inactive_stocks(stock_info: dict, now: datetime = None) -> dict:
+    """
+    辅助函数：剔除连续 EMPTY_STREAK_LIMIT 个交易日都没有新数据的股票 (疑似长期停牌或退市)。
+    提供 now (本次运行的北京时间，仅每日同步) 时，距上次复查超过 EMPTY_STREAK_REPROBE_DAYS 天则不做剔除，
+    让这些股票重新参与一次同步以发现复牌；未提供时 (校验修复) 只剔除，不复查也不写入复查记录。
+    """
+    empty_streaks = load_cache("empty_streaks") or {}
+    active_stock_info = {code: name for code, name in stock_info.items()
+                         if empty_streaks.get(code, 0) < EMPTY_STREAK_LIMIT}
+    skipped_count = len(stock_info) - len(active_stock_info)
+    if not skipped_count:
+        return stock_info
+
+    if now is not None:
+        reprobe_before = (now - timedelta(days=EMPTY_STREAK_REPROBE_DAYS)).strftime('%Y-%m-%d')
+        last_probe = (load_cache("empty_streak_probe") or {}).get("date", "")
+        if last_probe <= reprobe_before:
+            logging.info(f"重新检查 {skipped_count} 只长期没有新数据的股票 (每 {EMPTY_STREAK_REPROBE_DAYS} 天一次)。")
+            save_cache("empty_streak_probe", {"date": now.strftime('%Y-%m-%d')})
+            return stock_info
+
+    logging.info(f"跳过 {skipped_count} 只连续 {EMPTY_STREAK_LIMIT} 个交易日没有新数据的股票 (疑似长期停牌或退市)。")
+    return active_stock_info
+
+
+def update_empty_streaks(fetched_counts: dict, count_empty: bool):
+    """
+    辅助函数：根据本次获取到的新数据条数更新各股票连续无数据的次数。
+    有新数据的股票清零；count_empty 为 True 时 (每日同步)，没有新数据的股票计数加一。
+    所有股票都没有新数据时视为非交易日 (周末、节假日)，不增加计数。
+    """
+    empty_streaks = load_cache("empty_streaks") or {}
+    if count_empty and not any(fetched_counts.values()):
+        count_empty = False
+    for code, count in fetched_counts.items():
+        if count:
+            empty_streaks.pop(code, None)
+        elif count_empty:
+            empty_streaks[code] = empty_streaks.get(code, 0) + 1
+    save_cache("empty_streaks", empty_streaks)
 
 
 def verify_and_retry_sync(supabase_client: Client, target_stocks: dict):
@@ -134,52 +509,49 @@ def verify_and_retry_sync(supabase_client: Client, target_stocks: dict):
         return
     
     try:
-        # 1. 获取数据库中所有记录，以确定基准日期
-        response = supabase_client.table("csi800_daily_data").select("stock_code, trade_date").execute()
-        db_data = pd.DataFrame(response.data)
+        # 1. 通过数据库端聚合获取每只股票的最新交易日，避免下载整张表
+        db_summary = get_db_latest_dates(supabase_client, target_stocks)
         
-        if db_data.empty:
+        if not db_summary:
             logging.warning("数据库为空，无法执行校验。建议先运行 'partial' 或 'full' 模式进行初始化。")
             # 将所有目标股票视为缺失，并进行一次每日更新
             logging.info("将为所有目标股票执行一次每日增量同步...")
-            start_date_for_retry = (datetime.now() - timedelta(days=5)).strftime('%Y%m%d')
+            start_date_for_retry = (datetime.now(BEIJING_TZ) - timedelta(days=DAILY_LOOKBACK_DAYS)).strftime('%Y%m%d')
             fetch_and_insert_stocks(supabase_client, target_stocks, start_date_for_retry, "数据库初始化修复")
             return
             
         # 2. 确定唯一的最新交易日作为基准
-        latest_market_date = db_data['trade_date'].max()
+        latest_market_date = max(db_summary.values())
         logging.info(f"数据库中的最新交易日基准为: {latest_market_date}")
 
-        # 3. 找出所有落后或缺失的股票
-        db_summary = db_data.groupby('stock_code')['trade_date'].max()
-        
+        # 3. 找出所有落后或缺失的股票，落后的股票从其数据库中的最新日期开始补齐
         retry_stock_info = {}
-        # 找出数据落后的股票
-        lagging_codes = db_summary[db_summary < latest_market_date].index
-        for code in lagging_codes:
-            if code in target_stocks:
-                retry_stock_info[code] = target_stocks[code]
-
-        # 找出完全缺失的股票
-        db_codes = set(db_summary.index)
+        retry_start_dates = {}
         for code, name in target_stocks.items():
-            if code not in db_codes:
+            latest_date = db_summary.get(code)
+            # 数据落后 (latest_date 较旧) 或完全缺失 (latest_date 为 None)
+            if latest_date is None or latest_date < latest_market_date:
                 retry_stock_info[code] = name
+                if latest_date is not None:
+                    retry_start_dates[code] = latest_date.replace('-', '')
         
         if not retry_stock_info:
             logging.info(f"✅ 数据校验完成，所有股票数据都已更新至 {latest_market_date}。")
             return
 
-        logging.info(f"\n共发现 {len(retry_stock_info)} 只股票未达到最新日期。准备进行一次针对性的每日更新...")
+        logging.info(f"\n共发现 {len(retry_stock_info)} 只股票未达到最新日期。准备进行一次针对性的补齐更新...")
         
-        # 4. 对这些股票统一执行一次“每日更新”
-        start_date_for_retry = (datetime.now() - timedelta(days=5)).strftime('%Y%m%d')
-        fetch_and_insert_stocks(
+        # 4. 落后的股票从各自的最新日期开始补齐，完全缺失的股票执行一次“每日更新”
+        start_date_for_retry = (datetime.now(BEIJING_TZ) - timedelta(days=DAILY_LOOKBACK_DAYS)).strftime('%Y%m%d')
+        fetched_counts = fetch_and_insert_stocks(
             supabase_client=supabase_client,
             stock_info=retry_stock_info,
             start_date=start_date_for_retry,
-            task_desc="校验修复同步"
+            task_desc="校验修复同步",
+            start_dates=retry_start_dates,
+            latest_dates=db_summary
         )
+        update_empty_streaks(fetched_counts, count_empty=False)
 
     except Exception as e:
         logging.error(f"执行校验修复时发生严重错误: {e}")
@@ -206,6 +578,7 @@ def main():
     logging.info(f"--- 当前运行模式: {sync_mode} ---")
     
     supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    configure_postgrest_session(supabase)
     
     logging.info("正在获取最新的中证800成分股列表...")
     stock_info = get_csi800_stock_info()
@@ -214,16 +587,52 @@ def main():
         return
 
     if sync_mode == 'daily':
-        start_date = (datetime.now() - timedelta(days=5)).strftime('%Y%m%d')
-        fetch_and_insert_stocks(supabase, stock_info, start_date, "每日增量更新")
+        beijing_now = datetime.now(BEIJING_TZ)
+        today = beijing_now.strftime('%Y-%m-%d')
+        start_date = (beijing_now - timedelta(days=DAILY_LOOKBACK_DAYS)).strftime('%Y%m%d')
+        try:
+            latest_dates = get_db_latest_dates(supabase, stock_info)
+        except Exception as e:
+            logging.warning(f"获取数据库最新交易日失败，将上传全部数据 - {e}")
+            latest_dates = {}
+        # 今日 MARKET_SETTLED_TIME 之后已成功同步过、且数据库已有今日数据的股票，其K线已是最终数据，
+        # 同日重复运行时直接跳过；此前运行写入的K线可能尚未收盘，不记录也不跳过
+        after_close = beijing_now.strftime('%H:%M') >= MARKET_SETTLED_TIME
+        settled = load_cache("settled_stocks") or {}
+        settled_codes = set(settled.get("codes", [])) if after_close and settled.get("date") == today else set()
+        pending_stock_info = {code: name for code, name in filter_inactive_stocks(stock_info, beijing_now).items()
+                              if not (code in settled_codes and latest_dates.get(code) == today)}
+        if not pending_stock_info:
+            logging.info(f"✅ 所有股票数据都已在 {today} 收盘后同步完成，无需同步。")
+            return
+        # 数据库最新日期早于回溯窗口的股票 (如复查时已复牌的长期停牌股) 从其最新日期开始补齐
+        gap_start_dates = {code: latest_dates[code].replace('-', '') for code in pending_stock_info
+                           if code in latest_dates and latest_dates[code].replace('-', '') < start_date}
+        fetched_counts = fetch_and_insert_stocks(
+            supabase, pending_stock_info, start_date, "每日增量更新",
+            start_dates=gap_start_dates, latest_dates=latest_dates
+        )
+        update_empty_streaks(fetched_counts, count_empty=True)
+        if after_close:
+            save_cache("settled_stocks", {"date": today, "codes": sorted(settled_codes | fetched_counts.keys())})
     
     elif sync_mode == 'verify':
-        verify_and_retry_sync(supabase, stock_info)
+        verify_and_retry_sync(supabase, filter_inactive_stocks(stock_info))
 
     elif sync_mode in ['full', 'partial']:
         start_dates = {'full': "20050101", 'partial': "20150101"}
         task_desc = "全量历史同步" if sync_mode == 'full' else "部分历史同步"
-        fetch_and_insert_stocks(supabase, stock_info, start_dates[sync_mode], task_desc)
+        use_copy = bool(DATABASE_URL)
+        if not use_copy:
+            logging.info(f"未设置 DATABASE_URL，{task_desc}将通过 PostgREST 写入。")
+        if use_copy:
+            copy_pool.open(wait=True)
+        try:
+            fetch_and_insert_stocks(supabase, stock_info, start_dates[sync_mode], task_desc, use_copy=use_copy)
+        finally:
+            copy_pool.close()
+        # 历史同步覆盖了所有成分股，重置停牌/退市跳过名单
+        save_cache("empty_streaks", {})
 
 
 if __name__ == "__main__":